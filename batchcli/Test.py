@@ -1,5 +1,8 @@
+import sys
+import threading
 import unittest
-from batchcli import BatchCli, Cli, TaskEngine, Task
+from StringIO import StringIO
+from batchcli import BatchCli, Cli, SimpleCli, TaskEngine, Task
 
 
 class BatchCliTest(unittest.TestCase):
@@ -30,6 +33,20 @@ class BatchCliTest(unittest.TestCase):
     	self.c.newTask("Task 2")
     	self.assertEquals(self.cli.latestMessage, "[ 2/2 ] Task 2")
 
+    def test_newProgress(self):
+        self.c.newTask("Task 1")
+        self.c.newProgress(3, 5)
+        self.assertEquals(self.cli.latestUpdate, "[ 1/2 | 3/5 ]")
+        self.assertEquals(self.cli.latestMessage, "[ 1/2 ] Task 1")
+
+    def test_endProgress(self):
+        self.c.newTask("Task 1")
+        self.c.endProgress(5, 5)
+        self.assertEquals(self.cli.latestMessage, "[ 1/2 | 5/5 ]")
+
+        self.c.endProgress(5, 5, 2)
+        self.assertEquals(self.cli.latestMessage, "[ 1/2 | 5/5 ] 2 failed")
+
     def test_cannotExceedTaskCount(self):
     	with self.assertRaises(RuntimeError):
     	    self.c.newTask("Task 1")
@@ -234,6 +251,233 @@ class TaskEngineTest(unittest.TestCase):
 
         self.assertEquals(3, self.e.taskToRun())
 
+    def test_subtasks_run_on_the_engine(self):
+        task = SubtasksTask("T1", range(1, 101))
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertEquals([item * 2 for item in range(1, 101)], task.results)
+        self.assertFalse(task.failed)
+        self.assertEquals("[ 1/1 | 100/100 ]", self.cli.latestMessage)
+        self.assertEquals(1, self.cli.messages.count("[ 1/1 | 100/100 ]"))
+        self.assertIsNone(self.e.pool)
+
+    def test_failing_subtask_marks_task_failed(self):
+        task1 = SubtasksTask("T1", [1, 0, 2])
+        task2 = MockTask("T2")
+        self.e.addTask(task1)
+        self.e.addTask(task2)
+        self.e.run()
+
+        self.assertEquals([2, None, 4], task1.results)
+        self.assertTrue(task1.failed)
+        self.assertFalse(task2.executed)
+        self.assertIn("[ 1/2 | 3/3 ] 1 failed", self.cli.messages)
+        self.assertEquals("[ ... ] 0: Cannot double zero", self.cli.latestMessage)
+        self.assertEquals(1, len(task1.subtaskErrors))
+        item, error = task1.subtaskErrors[0]
+        self.assertEquals(0, item)
+        self.assertIsInstance(error, ValueError)
+
+    def test_failing_subtask_without_failOnError(self):
+        task = SubtasksTask("T1", [1, 0, 2], failOnError=False)
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertEquals([2, None, 4], task.results)
+        self.assertFalse(task.failed)
+        self.assertEquals("[ ... ] 0: Cannot double zero", self.cli.latestMessage)
+
+    def test_subtasks_run_concurrently_on_pool_threads(self):
+        task = ConcurrentTask("T1")
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertEquals([True, True], task.results)
+        self.assertNotIn(threading.current_thread().name, task.threadNames)
+
+    def test_nested_subtasks_run_in_sequence(self):
+        self.e = TaskEngine(self.cli, workers=1)
+        task = NestedTask("T1")
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertEquals([[2, 4], [6, 8]], task.results)
+        self.assertFalse(task.failed)
+
+    def test_nested_subtask_failure_is_reported(self):
+        self.e = TaskEngine(self.cli, workers=1)
+        task = NestedTask("T1", lambda item: 10 / item, [[1, 0], [3, 4]])
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertEquals([None, [3, 2]], task.results)
+        self.assertTrue(task.failed)
+        self.assertIn("[ 1/1 | 2/2 ] 1 failed", self.cli.messages)
+        self.assertEquals("[ ... ] [1, 0]: integer division or modulo by zero", self.cli.latestMessage)
+        self.assertEquals(1, len(task.subtaskErrors))
+        item, error = task.subtaskErrors[0]
+        self.assertEquals([1, 0], item)
+        self.assertIsInstance(error, ZeroDivisionError)
+
+    def test_subtask_errors_are_kept_across_calls(self):
+        task = TwiceSubtasksTask("T1")
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertTrue(task.failed)
+        self.assertEquals([0, 0], [item for item, error in task.subtaskErrors])
+
+        self.e = TaskEngine(self.cli)
+        self.e.addTask(task)
+        task.failed = False
+        self.e.run()
+
+        self.assertEquals(2, len(task.subtaskErrors))
+
+    def test_engine_is_cleared_after_run(self):
+        task = SubtasksTask("T1", [1, 2])
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertIsNone(task.engine)
+
+    def test_pool_is_terminated_when_a_task_raises(self):
+        self.e.addTask(RaisingTask("T1"))
+
+        with self.assertRaises(RuntimeError):
+            self.e.run()
+        self.assertIsNone(self.e.pool)
+
+    def test_progress_updates_are_throttled(self):
+        task = SubtasksTask("T1", range(1, 1001))
+        self.e.addTask(task)
+        self.e.run()
+
+        self.assertTrue(self.cli.countUpdate <= 101)
+        self.assertEquals("[ 1/1 | 1000/1000 ]", self.cli.latestUpdate)
+        self.assertEquals("[ 1/1 | 1000/1000 ]", self.cli.latestMessage)
+
+
+class TaskTest(unittest.TestCase):
+
+    def test_runSubtasks_outside_an_engine(self):
+        cli = FakeCli()
+        batchCli = BatchCli(cli)
+        batchCli.expectTaskCount(1)
+        batchCli.newTask("T1")
+
+        task = SubtasksTask("T1", [1, 2, 3])
+        task.run(batchCli)
+
+        self.assertEquals([2, 4, 6], task.results)
+        self.assertEquals("[ 1/1 | 3/3 ]", cli.latestUpdate)
+        self.assertEquals("[ 1/1 | 3/3 ]", cli.latestMessage)
+
+
+class SimpleCliTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+        self.cli = SimpleCli()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_update_rewrites_the_line(self):
+        self.cli.update("[ 1/1 | 1/20 ]")
+        self.cli.update("[ 1/1 | 2/20 ]")
+
+        self.assertEquals("[ 1/1 | 1/20 ]\r" + " " * 14 + "\r[ 1/1 | 2/20 ]", sys.stdout.getvalue())
+
+    def test_log_clears_the_update(self):
+        self.cli.update("[ 1/1 | 1/2 ]")
+        self.cli.log("[ 1/1 | 2/2 ]")
+
+        self.assertEquals("[ 1/1 | 1/2 ]\r" + " " * 13 + "\r[ 1/1 | 2/2 ]\n", sys.stdout.getvalue())
+
+    def test_log_without_update(self):
+        self.cli.log("[ ... ] Message")
+
+        self.assertEquals("[ ... ] Message\n", sys.stdout.getvalue())
+
+    def test_ask_clears_the_update(self):
+        import __builtin__
+        rawInput = __builtin__.raw_input
+        __builtin__.raw_input = lambda message: sys.stdout.write(message) or "answer"
+        try:
+            self.cli.update("[ 1/1 | 1/2 ]")
+            answer = self.cli.ask("[  ?  ] A question")
+        finally:
+            __builtin__.raw_input = rawInput
+
+        self.assertEquals("answer", answer)
+        self.assertEquals("[ 1/1 | 1/2 ]\r" + " " * 13 + "\r[  ?  ] A question", sys.stdout.getvalue())
+
+
+class SubtasksTask(Task):
+
+    def __init__(self, name, items, failOnError=True):
+        Task.__init__(self, name)
+        self.items = items
+        self.failOnError = failOnError
+        self.results = None
+
+    def run(self, cli):
+        self.results = self.runSubtasks(cli, self.double, self.items, self.failOnError)
+
+    def double(self, item):
+        if item == 0:
+            raise ValueError("Cannot double zero")
+        return item * 2
+
+class ConcurrentTask(Task):
+    "Two subtasks that complete only when running at the same time."
+
+    def __init__(self, name):
+        Task.__init__(self, name)
+        self.started = [threading.Event(), threading.Event()]
+        self.threadNames = []
+        self.results = None
+
+    def run(self, cli):
+        self.results = self.runSubtasks(cli, self.waitForTheOther, [0, 1])
+
+    def waitForTheOther(self, item):
+        self.threadNames.append(threading.current_thread().name)
+        self.started[item].set()
+        return self.started[1 - item].wait(5)
+
+class NestedTask(Task):
+
+    def __init__(self, name, function=lambda item: item * 2, items=[[1, 2], [3, 4]]):
+        Task.__init__(self, name)
+        self.function = function
+        self.items = items
+        self.results = None
+
+    def run(self, cli):
+        self.results = self.runSubtasks(cli, self.runInner, self.items)
+
+    def runInner(self, items):
+        return self.runSubtasks(None, self.function, items)
+
+class TwiceSubtasksTask(SubtasksTask):
+
+    def __init__(self, name):
+        SubtasksTask.__init__(self, name, [0, 1])
+
+    def run(self, cli):
+        self.runSubtasks(cli, self.double, self.items, failOnError=False)
+        self.runSubtasks(cli, self.double, self.items)
+
+class RaisingTask(Task):
+
+    def run(self, cli):
+        self.runSubtasks(cli, lambda item: item, [1, 2])
+        raise RuntimeError("Task error")
+
 class MockTask(Task):
 
     def __init__(self, name):
@@ -251,10 +495,16 @@ class FakeCli(Cli):
         self.expectedMessages = []
         self.messages = []
         self.latestMessage = ""
+        self.latestUpdate = ""
+        self.countUpdate = 0
 
     def log(self, message):
         self.latestMessage = message
         self.messages.append(message)
+
+    def update(self, message):
+        self.latestUpdate = message
+        self.countUpdate = self.countUpdate + 1
 		
     def ask(self, message):
         self.latestMessage = message
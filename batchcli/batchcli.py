@@ -7,17 +7,26 @@ Author: siasi@cisco.com
 Date: December 2013
 """
 
+import sys
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 class TaskEngine():
     """The Task Engine is able to run multiple Tasks in sequence.
     Stop immediately when a task fails. Uses a BatchCli to collect input
     and provide output for each Task.
     """
 
-    def __init__(self, cli):
-        "Needs a BatchCli to read/print input and output before runnign the tasks"
+    def __init__(self, cli, workers=4):
+        """Needs a BatchCli to read/print input and output before runnign the tasks.
+        The number of workers is the size of the pool used to run subtasks.
+        """
         
         self.tasks = []
         self.cli = BatchCli(cli)
+        self.workers = workers
+        self.pool = None
 
     def addTask(self, task):
         "Add a task to be run. The method should be invocked before run()."
@@ -29,16 +38,60 @@ class TaskEngine():
         """
 
         self.cli.expectTaskCount(self.taskToRun())
-        for task in self.tasks:
-            self.cli.newTask(task.name)
-            task.run(self.cli)
-            if task.failed:
-                return
+        try:
+            for task in self.tasks:
+                self.cli.newTask(task.name)
+                task.engine = self
+                task.subtaskErrors = []
+                try:
+                    task.run(self.cli)
+                finally:
+                    task.engine = None
+                if task.failed:
+                    return
+        except:
+            self.__terminatePool()
+            raise
+        finally:
+            self.__closePool()
+
+    def map(self, function, items):
+        """Apply function to each item using the pool of workers.
+        Return an iterator of (index, result) pairs in completion order.
+        The pool is created the first time it is needed.
+        """
+
+        if self.pool is None:
+            self.pool = ThreadPool(self.workers)
+        pairs = list(enumerate(items))
+        outcomes = self.pool.imap_unordered(function, pairs)
+        for count in range(len(pairs)):
+            yield self.__next(outcomes)
 
     def taskToRun(self):
         "Return the number of tasks to run."
         return len(self.tasks)
 
+    def __next(self, outcomes):
+        # Wait with a timeout: on Python 2 a wait without timeout
+        # cannot be interrupted by Ctrl-C.
+        while True:
+            try:
+                return outcomes.next(0.1)
+            except TimeoutError:
+                pass
+
+    def __closePool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __terminatePool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
 
 class Task():
     "A task executed by the Task Engine"
@@ -46,11 +99,68 @@ class Task():
     def __init__(self, name):
         self.name = name
         self.failed = False
+        self.engine = None
+        self.subtaskErrors = []
 
     def run(self, cli):
         "Perform the work of this task."
         pass
 
+    def runSubtasks(self, cli, function, items, failOnError=True):
+        """Run function on each item as a subtask and wait for all of them.
+        Subtasks run on the workers of the Task Engine running this task,
+        or in sequence when the task is run outside an engine.
+
+        The progress is shown on the cli as a single updating counter,
+        followed by a message for each failing subtask. The failing items
+        and their exceptions are added to subtaskErrors as (item, error) pairs.
+        Return the list of results in the same order of items, with None
+        for the subtasks raising an exception. If failOnError is True
+        a failing subtask marks this task as failed.
+
+        When called from a subtask, the items run in sequence on the
+        worker of the calling subtask and no progress is shown. If
+        failOnError is True the first error is raised, so that the
+        calling subtask fails and reports it.
+        """
+
+        items = list(items)
+        total = len(items)
+        results = [None] * total
+        errors = []
+
+        nested = _isSubtask()
+        call = _SubtaskCall(function)
+        if self.engine is None or nested:
+            outcomes = (call(pair) for pair in enumerate(items))
+        else:
+            outcomes = self.engine.map(call, items)
+
+        step = max(1, total // 100)
+        if not nested:
+            cli.newProgress(0, total)
+        for done, (index, succeeded, value) in enumerate(outcomes, 1):
+            if succeeded:
+                results[index] = value
+            else:
+                errors.append((items[index], value))
+            if not nested and done % step == 0:
+                cli.newProgress(done, total)
+
+        if nested:
+            if errors and failOnError:
+                raise errors[0][1]
+            return results
+
+        cli.endProgress(total, total, len(errors))
+        for item, error in errors:
+            cli.newMessage("%s: %s" % (item, error))
+
+        self.subtaskErrors.extend(errors)
+        if errors and failOnError:
+            self.failed = True
+        return results
+
     def __key(self):
         return self.name
 
@@ -67,6 +177,33 @@ class Task():
         return self.name
 
 
+_subtaskState = threading.local()
+
+def _isSubtask():
+    "Return True if the current thread is running a subtask."
+    return getattr(_subtaskState, 'running', False)
+
+
+class _SubtaskCall():
+    """Wrap the function run by a subtask so that an exception does not
+    stop the other subtasks. Return a tuple (index, succeeded, value).
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, pair):
+        index, item = pair
+        running = _isSubtask()
+        _subtaskState.running = True
+        try:
+            return index, True, self.function(item)
+        except Exception, e:
+            return index, False, e
+        finally:
+            _subtaskState.running = running
+
+
 class BatchCli():
     """This class provides a simple API to ask input to the user and 
        track the progress of tasks execution sending message to a cli.
@@ -99,6 +236,23 @@ class BatchCli():
         output = self.__buildMessageOutput(message)
         self.cli.log(output)
 
+    def newProgress(self, done, total):
+        """Send to the cli the progress of the subtasks of the current task.
+        The cli shows it as a single counter updated in place.
+        """
+
+        output = self.__buildProgressOutput(done, total)
+        if hasattr(self.cli, 'update'):
+            self.cli.update(output)
+
+    def endProgress(self, done, total, errors=0):
+        "Send to the cli the final progress of the subtasks of the current task."
+
+        output = self.__buildProgressOutput(done, total)
+        if errors:
+            output += " " + str(errors) + " failed"
+        self.cli.log(output)
+
     def newTask(self, taskName):
         """Send to the CLI a message saying the task passed as 
         parameter is starting execution."""
@@ -244,6 +398,11 @@ class BatchCli():
         self.tokens[3] = message
         return " ".join(self.tokens)
 
+    def __buildProgressOutput(self, done, total):
+        self.tokens[1] = self.__getProgressIndex() + " | " + str(done) + "/" + str(total)
+        self.tokens[3] = ""
+        return " ".join(self.tokens).rstrip()
+
     def __buildMessageOutput(self, message):
         self.tokens[1] = "..."
         self.tokens[3] = message
@@ -271,6 +430,10 @@ class Cli():
     def log(self, message):
         pass
 
+    def update(self, message):
+        "Replace the latest updated message. Used to show progress in place."
+        pass
+
     def ask(self, message):
         pass
 
@@ -280,12 +443,28 @@ class SimpleCli():
     Print and read from Standard Input and Standard Output.
     """
 
+    updateLength = 0
+
     def log(self, message):
         "Print the message to Standard Ouput"
+        self.__clearUpdate()
         print message
 
+    def update(self, message):
+        "Print the message to Standard Ouput over the latest updated message."
+        self.__clearUpdate()
+        sys.stdout.write(message)
+        sys.stdout.flush()
+        self.updateLength = len(message)
+
+    def __clearUpdate(self):
+        if self.updateLength:
+            sys.stdout.write("\r" + " " * self.updateLength + "\r")
+            self.updateLength = 0
+
     def ask(self, message):
         "Print the message to Standard Ouput and read the input from Standard Input."
+        self.__clearUpdate()
         return raw_input(message)
 
 
@@ -306,6 +485,12 @@ if __name__ == "__main__":
             cli.newMessage("Throw the eggshell ...")
             cli.newMessage("Put the eggs into the pan ...")
 
+    class AddSalt(Task):
+        "Subtasks: add the salt one grain at a time."
+
+        def run(self, cli):
+            self.runSubtasks(cli, lambda grain: grain, range(5000))
+
     cli = SimpleCli()
     engine = TaskEngine(cli)
 
@@ -314,6 +499,7 @@ if __name__ == "__main__":
     #engine.addTask(CookingEggs("Cooking the eggs"))
     engine.addTask(Print("Wait the eggs is cooked"))
     engine.addTask(Print("Put the eggs in the dish"))
-    engine.addTask(Print("Add salt to the eggs and eat it!"))
+    engine.addTask(AddSalt("Add salt to the eggs"))
+    engine.addTask(Print("Eat it!"))
 
     engine.run()